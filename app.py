@@ -4,76 +4,178 @@ It works as follows:
     - a user selects and uploads a .txt file that contains 1 sentence per line
     - the backend stores the
 """
-from flask import Flask, render_template, request, jsonify, send_file, session
+from flask import Flask, render_template, request, jsonify, session, redirect, g
+from flask_executor import Executor
 import os
-from zipfile import ZipFile
-from io import BytesIO
+import shutil
+import threading
+import time
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 import hashlib
 import uuid
 import json
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
 from dotenv import load_dotenv
-import firebase_admin
-from firebase_admin import credentials, storage
+from firebase_admin import credentials
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import storage
+from google.cloud.exceptions import NotFound
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 
 app = Flask(__name__)
+# Background workers for assembling recordings ZIPs
+executor = Executor(app)
 app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24).hex())
+# Reject oversized request bodies before they are read
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
+# Maximum number of connections kept open to Cloud Storage
+HTTP_POOL_SIZE = 32
 
 # Initialize Firebase
 firebase_creds = json.loads(os.environ.get('FIREBASE_CREDENTIALS', '{}'))
 if firebase_creds:
-    cred = credentials.Certificate(firebase_creds)
-    firebase_admin.initialize_app(cred, {
-        'storageBucket': os.environ.get('FIREBASE_BUCKET')
-    })
-    bucket = storage.bucket()
+    cred = credentials.Certificate(firebase_creds).get_credential()
+    # Give the storage client its own authorized session whose connection
+    # pool is large enough that concurrent uploads and ZIP jobs reuse open
+    # TLS connections instead of handshaking again. The mTLS channel is
+    # configured the same way storage.Client does for the session it creates;
+    # when mTLS is enabled its adapter takes over from the pooled one.
+    http = AuthorizedSession(cred)
+    http.mount(
+        'https://', HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+    )
+    http.configure_mtls_channel()
+    # _http is storage.Client's (underscore-marked) hook for supplying the
+    # session; every bucket, blob and batch call made through it uses it
+    client = storage.Client(
+        project=firebase_creds.get('project_id'), credentials=cred, _http=http
+    )
+    bucket = client.bucket(os.environ.get('FIREBASE_BUCKET'))
 else:
     bucket = None
     print("WARNING: Firebase not configured, using local storage")
 
 LOCAL_SENTENCES_FILE = "last_uploaded_sentences.txt"
 
-
-def get_session_id():
-    """Get or create a unique session ID for the current user."""
+# Maximum number of calls Cloud Storage accepts in one batch request
+MAX_BATCH_SIZE = 100
+# Longest sentence accepted with an audio upload. Cloud Storage allows at
+# most 8 KiB of custom metadata per object, and the sentence is stored there
+MAX_SENTENCE_BYTES = 4 * 1024
+# How long signed download URLs handed to the client stay valid
+SIGNED_URL_EXPIRATION = timedelta(minutes=10)
+# How long a finished ZIP is kept in Firebase. Its signed URL expires first;
+# the extra time lets a download started just before that finish
+ZIP_RETENTION = SIGNED_URL_EXPIRATION + timedelta(minutes=10)
+
+# Clips downloaded in parallel while building a ZIP. Each waits in a temp
+# file, held in memory up to CLIP_SPOOL_SIZE, until it is copied in.
+DOWNLOAD_WORKERS = 16
+CLIP_SPOOL_SIZE = 1024 * 1024
+COPY_CHUNK_SIZE = 64 * 1024
+download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+
+# ZIP download jobs started by this process, by job key, and the job being
+# built for each session. Job state lives only in this process, so with
+# several workers (e.g. gunicorn -w N) a poll must reach the worker that
+# started the job. ZIPs of jobs lost to a restart are not cleaned up here.
+DOWNLOAD_JOBS = {}
+ACTIVE_DOWNLOADS = {}
+DOWNLOAD_JOBS_LOCK = threading.RLock()
+
+
+@app.before_request
+def load_session_id():
+    """Get or create a unique session ID for the current user.
+
+    Resolved once per request and cached on ``g.session_id``.
+    """
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
-    return session['session_id']
+    g.session_id = session['session_id']
+
+
+class AudioStream:
+    """Reads the audio that follows the sentence line of an upload's body.
 
+    Resumable uploads require the stream to start at position 0, so tell()
+    counts from where the audio begins rather than from the start of the body.
+    """
 
-def upload_to_firebase(file_data, blob_path):
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+
+def upload_to_firebase(file_data, blob_path, size=None, metadata=None,
+                       content_type='audio/webm'):
     """Upload file data to Firebase Storage."""
     if bucket:
         blob = bucket.blob(blob_path)
-        blob.upload_from_file(file_data, content_type='audio/webm')
+        # Custom metadata is sent with the upload itself, not as a separate call
+        blob.metadata = metadata
+        blob.upload_from_file(file_data, size=size, content_type=content_type)
         return True
     return False
 
 
-def download_from_firebase(blob_path):
-    """Download file from Firebase Storage."""
+def download_from_firebase(blob_path, file_obj):
+    """Download file from Firebase Storage into a writable file object."""
     if bucket:
-        blob = bucket.blob(blob_path)
-        if blob.exists():
-            data = BytesIO()
-            blob.download_to_file(data)
-            data.seek(0)
-            return data
-    return None
+        try:
+            bucket.blob(blob_path).download_to_file(file_obj)
+            return True
+        except NotFound:
+            pass
+    return False
 
 
-def delete_from_firebase(blob_path):
-    """Delete file from Firebase Storage."""
+def delete_many_from_firebase(blob_paths):
+    """Delete files from Firebase Storage using batched requests."""
     if bucket:
-        blob = bucket.blob(blob_path)
-        if blob.exists():
-            blob.delete()
-
-
-def get_user_mapping_path(session_id):
-    """Get the Firebase path for user's mapping file."""
-    return f"{session_id}/mapping.json"
+        for i in range(0, len(blob_paths), MAX_BATCH_SIZE):
+            chunk = blob_paths[i:i + MAX_BATCH_SIZE]
+            batch = bucket.client.batch(raise_exception=False)
+            with batch:
+                for blob_path in chunk:
+                    bucket.blob(blob_path).delete()
+            # The batch keeps one response per deferred call in _responses;
+            # the context manager discards finish()'s return value. Files
+            # that are already gone (404) count as deleted.
+            failed = [
+                f"{blob_path} ({response.status_code})"
+                for blob_path, response in zip(chunk, batch._responses)
+                if not (200 <= response.status_code < 300
+                        or response.status_code == 404)
+            ]
+            if failed:
+                app.logger.error(
+                    "Failed to delete from Firebase: %s", ', '.join(failed)
+                )
+
+
+def get_job_key(session_id, job_id):
+    """Get the key in DOWNLOAD_JOBS for a user's ZIP job, scoped to their session."""
+    return f"{session_id}/{job_id}"
+
+
+def get_user_zip_path(session_id, job_id):
+    """Get the Firebase path for the recordings ZIP built by a user's job."""
+    return f"{session_id}/{job_id}.zip"
 
 
 def get_user_audio_path(session_id, filename):
@@ -82,21 +184,145 @@ def get_user_audio_path(session_id, filename):
 
 
 def load_user_mappings(session_id):
-    """Load user's audio mappings from Firebase."""
-    mapping_path = get_user_mapping_path(session_id)
-    data = download_from_firebase(mapping_path)
-    if data:
-        return json.load(data)
-    return {}
-
-
-def save_user_mappings(session_id, mappings):
-    """Save user's audio mappings to Firebase."""
-    mapping_path = get_user_mapping_path(session_id)
-    data = BytesIO(json.dumps(mappings).encode('utf-8'))
-    if bucket:
-        blob = bucket.blob(mapping_path)
-        blob.upload_from_file(data, content_type='application/json')
+    """Load user's audio mappings from the metadata of their Firebase files.
+
+    Mappings are returned in the order the audio files were uploaded.
+    """
+    if not bucket:
+        return {}
+    blobs = sorted(
+        bucket.list_blobs(prefix=f"{session_id}/"), key=lambda b: b.time_created
+    )
+    return {
+        blob.name.rsplit('/', 1)[-1]: blob.metadata['sentence']
+        for blob in blobs
+        if blob.metadata and 'sentence' in blob.metadata
+    }
+
+
+def fetch_clip(blob_path):
+    """Download a clip into a spooled temp file, or return None if missing."""
+    clip = tempfile.SpooledTemporaryFile(max_size=CLIP_SPOOL_SIZE)
+    if download_from_firebase(blob_path, clip):
+        clip.seek(0)
+        return clip
+    clip.close()
+    return None
+
+
+def write_recordings_zip(file_obj, session_id, mappings):
+    """Write user's audio files and their TSV mapping into a ZIP archive.
+
+    Clips are downloaded in parallel, at most DOWNLOAD_WORKERS at a time,
+    and written into the archive in order from the calling thread since
+    ZipFile is not thread-safe. Clips missing from Firebase are left out of
+    both the archive and the TSV. Returns the filenames that were added.
+    """
+    added = []
+    filenames = iter(mappings)
+    pending = deque()
+
+    def fetch_next():
+        filename = next(filenames, None)
+        if filename is not None:
+            audio_path = get_user_audio_path(session_id, filename)
+            pending.append((filename, download_pool.submit(fetch_clip, audio_path)))
+
+    for _ in range(DOWNLOAD_WORKERS):
+        fetch_next()
+
+    try:
+        # WebM/Opus audio is already compressed, so it is stored as-is; only
+        # the TSV is deflated
+        with ZipFile(file_obj, 'w', compression=ZIP_STORED) as zf:
+            while pending:
+                filename, future = pending.popleft()
+                fetch_next()
+                clip = future.result()
+                if clip is None:
+                    continue
+                with clip, zf.open(filename, 'w') as dst:
+                    shutil.copyfileobj(clip, dst, COPY_CHUNK_SIZE)
+                added.append(filename)
+
+            tsv_content = "audio_filename\tsentence\n" + '\n'.join(
+                f"{fn}\t{mappings[fn]}" for fn in added
+            )
+            zf.writestr("mapping.tsv", tsv_content, compress_type=ZIP_DEFLATED)
+    finally:
+        # On failure, drop the downloads that were still queued or in flight
+        for _, future in pending:
+            if not future.cancel() and future.exception() is None:
+                clip = future.result()
+                if clip:
+                    clip.close()
+
+    return added
+
+
+def build_recordings_zip(session_id, job_id):
+    """Assemble user's recordings ZIP in Firebase and return a signed URL to it.
+
+    Runs in the background executor. Returns None if there are no recordings.
+    """
+    mappings = load_user_mappings(session_id)
+    if not mappings:
+        return None
+
+    with tempfile.TemporaryFile() as tmp:
+        added = write_recordings_zip(tmp, session_id, mappings)
+        if not added:
+            return None
+        size = tmp.tell()
+        tmp.seek(0)
+        upload_to_firebase(
+            tmp, get_user_zip_path(session_id, job_id), size=size,
+            content_type='application/zip',
+        )
+
+    # Delete from Firebase only the clips that made it into the ZIP
+    delete_many_from_firebase(
+        [get_user_audio_path(session_id, fn) for fn in added]
+    )
+
+    blob = bucket.blob(get_user_zip_path(session_id, job_id))
+    return blob.generate_signed_url(
+        version='v4', expiration=SIGNED_URL_EXPIRATION,
+        response_disposition='attachment; filename=recordings.zip',
+    )
+
+
+def finish_download_job(session_id, job_id, future):
+    """Mark a ZIP job finished so its ZIP is removed after ZIP_RETENTION."""
+    error = future.exception()
+    if error:
+        app.logger.error(
+            "Building recordings ZIP %s failed", job_id, exc_info=error
+        )
+    with DOWNLOAD_JOBS_LOCK:
+        if ACTIVE_DOWNLOADS.get(session_id) == job_id:
+            del ACTIVE_DOWNLOADS[session_id]
+        job = DOWNLOAD_JOBS.get(get_job_key(session_id, job_id))
+        if job:
+            job['expires'] = time.monotonic() + ZIP_RETENTION.total_seconds()
+
+
+def prune_download_jobs():
+    """Forget expired ZIP jobs and delete their ZIPs from Firebase.
+
+    Must be called with DOWNLOAD_JOBS_LOCK held.
+    """
+    now = time.monotonic()
+    expired = [
+        key for key, job in DOWNLOAD_JOBS.items()
+        if job['expires'] is not None and job['expires'] <= now
+    ]
+    zip_paths = []
+    for key in expired:
+        job = DOWNLOAD_JOBS.pop(key)
+        zip_paths.append(get_user_zip_path(job['session_id'], job['job_id']))
+    if zip_paths:
+        executor.submit(delete_many_from_firebase, zip_paths)
 
 
 @app.route('/')
@@ -107,8 +333,13 @@ def index():
 @app.route('/upload-sentences', methods=['POST'])
 def upload():
     file = request.files['file']
-    sentences = file.read().decode('utf-8').split('\n')
-    sentences = [s.strip() for s in sentences if s.strip()]
+    # Parse line by line so the upload is never decoded as a whole; the file
+    # is only written once every line has decoded
+    sentences = []
+    for line in file.stream:
+        sentence = line.decode('utf-8').strip()
+        if sentence:
+            sentences.append(sentence)
     with open(LOCAL_SENTENCES_FILE, 'w', encoding='utf-8') as f:
         f.write('\n'.join(sentences))
     return jsonify(sentences)
@@ -116,60 +347,93 @@ def upload():
 
 @app.route('/upload-audio', methods=['POST'])
 def upload_audio():
-    audio = request.files['audio']
-    sentence = request.form.get("sentence_text")
-    md5hash = hashlib.md5(sentence.encode())
-    filename = f"{md5hash.hexdigest()}.webm"
-
-    session_id = get_session_id()
-
-    # Upload audio to Firebase
+    # The body is the UTF-8 sentence on its own line followed by the raw
+    # audio, so the audio can be streamed to Firebase as it arrives without
+    # form parsing spooling it to memory/disk
+    line = request.stream.readline(MAX_SENTENCE_BYTES + 1)
+    if not line.endswith(b'\n'):
+        return f'Sentence missing or longer than {MAX_SENTENCE_BYTES} bytes', 400
+    try:
+        # Stripped the same way /upload-sentences strips each line, so the
+        # filename hash matches however the client ended the line
+        sentence = line.decode('utf-8').strip()
+    except UnicodeDecodeError:
+        return 'Sentence is not valid UTF-8', 400
+    if not sentence:
+        return 'Sentence missing', 400
+    sentence_hash = hashlib.blake2b(sentence.encode('utf-8'), digest_size=16)
+    filename = f"{sentence_hash.hexdigest()}.webm"
+
+    session_id = g.session_id
+
+    # Upload audio to Firebase, recording its sentence in the file's metadata
     audio_path = get_user_audio_path(session_id, filename)
-    upload_to_firebase(audio, audio_path)
-
-    # Update mappings in Firebase
-    mappings = load_user_mappings(session_id)
-    mappings[filename] = sentence
-    save_user_mappings(session_id, mappings)
+    size = request.content_length
+    if size is not None:
+        size -= len(line)
+    upload_to_firebase(
+        AudioStream(request.stream), audio_path, size, {'sentence': sentence}
+    )
 
     return 'Audio received', 200
 
 
-@app.route('/download-recordings')
-def download_recordings():
-    session_id = get_session_id()
+@app.route('/audio/<filename>')
+def download_audio(filename):
+    """Redirect to a signed URL so the clip is served by Firebase directly."""
+    if not bucket:
+        return 'Recording not found', 404
+    blob = bucket.blob(get_user_audio_path(g.session_id, filename))
+    url = blob.generate_signed_url(version='v4', expiration=SIGNED_URL_EXPIRATION)
+    return redirect(url)
 
-    # Load mappings from Firebase
-    mappings = load_user_mappings(session_id)
 
-    if not mappings:
+@app.route('/download-recordings', methods=['POST'])
+def download_recordings():
+    """Start building the user's recordings ZIP in the background.
+
+    While a ZIP is still being built for the session, its job is returned
+    instead of starting another one.
+    """
+    session_id = g.session_id
+    with DOWNLOAD_JOBS_LOCK:
+        prune_download_jobs()
+        job_id = ACTIVE_DOWNLOADS.get(session_id)
+        if job_id is None:
+            job_id = str(uuid.uuid4())
+            future = executor.submit(build_recordings_zip, session_id, job_id)
+            DOWNLOAD_JOBS[get_job_key(session_id, job_id)] = {
+                'session_id': session_id,
+                'job_id': job_id,
+                'future': future,
+                'expires': None,
+            }
+            ACTIVE_DOWNLOADS[session_id] = job_id
+            future.add_done_callback(
+                lambda f: finish_download_job(session_id, job_id, f)
+            )
+    return jsonify({'job_id': job_id}), 202
+
+
+@app.route('/download-recordings/<job_id>')
+def download_recordings_status(job_id):
+    """Poll a ZIP build; once finished, return the signed URL of the ZIP."""
+    with DOWNLOAD_JOBS_LOCK:
+        prune_download_jobs()
+        job = DOWNLOAD_JOBS.get(get_job_key(g.session_id, job_id))
+    if job is None:
+        return 'Download job not found', 404
+    if not job['future'].done():
+        return jsonify({'status': 'pending'}), 202
+
+    if job['future'].exception():
+        return jsonify({
+            'status': 'failed', 'error': 'Building the recordings ZIP failed',
+        }), 502
+    url = job['future'].result()
+    if not url:
         return 'No recordings found', 404
-
-    # Create TSV content
-    tsv_content = "audio_filename\tsentence\n" + '\n'.join(
-        f"{fn}\t{sent}" for fn, sent in mappings.items()
-    )
-
-    # Create ZIP file
-    memory_file = BytesIO()
-    with ZipFile(memory_file, 'w') as zf:
-        # Add audio files from Firebase
-        for filename, _ in mappings.items():
-            audio_path = get_user_audio_path(session_id, filename)
-            audio_data = download_from_firebase(audio_path)
-            if audio_data:
-                zf.writestr(filename, audio_data.read())
-                # Delete from Firebase after adding to ZIP
-                delete_from_firebase(audio_path)
-
-        # Add TSV mapping
-        zf.writestr("mapping.tsv", tsv_content)
-
-    # Delete mapping file from Firebase
-    delete_from_firebase(get_user_mapping_path(session_id))
-
-    memory_file.seek(0)
-    return send_file(memory_file, as_attachment=True, download_name='recordings.zip')
+    return jsonify({'status': 'done', 'url': url})
 
 
 if __name__ == "__main__":
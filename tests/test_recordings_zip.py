@@ -0,0 +1,117 @@
+import io
+import os
+import threading
+import time
+import zipfile
+
+os.environ['FIREBASE_CREDENTIALS'] = '{}'
+
+import app as sabre  # noqa: E402
+
+
+def test_write_recordings_zip_downloads_in_parallel_and_skips_missing(monkeypatch):
+    clips = {f'{i}.webm': bytes([i]) * 1000 for i in range(20) if i != 3}
+    in_flight = 0
+    most_in_flight = 0
+    lock = threading.Lock()
+
+    def fake_download(blob_path, file_obj):
+        nonlocal in_flight, most_in_flight
+        with lock:
+            in_flight += 1
+            most_in_flight = max(most_in_flight, in_flight)
+        time.sleep(0.05)
+        with lock:
+            in_flight -= 1
+        data = clips.get(blob_path.split('/')[-1])
+        if data is None:
+            return False
+        file_obj.write(data)
+        return True
+
+    monkeypatch.setattr(sabre, 'download_from_firebase', fake_download)
+    mappings = {f'{i}.webm': f'Sentence {i}' for i in range(20)}
+
+    buf = io.BytesIO()
+    added = sabre.write_recordings_zip(buf, 'session', mappings)
+
+    expected = [fn for fn in mappings if fn in clips]
+    assert added == expected
+    assert 1 < most_in_flight <= sabre.DOWNLOAD_WORKERS
+    with zipfile.ZipFile(buf) as zf:
+        assert zf.namelist() == expected + ['mapping.tsv']
+        assert all(zf.read(fn) == clips[fn] for fn in expected)
+        tsv = zf.read('mapping.tsv').decode().splitlines()
+        assert tsv[0] == 'audio_filename\tsentence'
+        assert '3.webm\tSentence 3' not in tsv
+        assert len(tsv) == len(expected) + 1
+
+
+def test_delete_many_from_firebase_logs_failures_but_not_missing(monkeypatch, caplog):
+    statuses = {'s/a.webm': 204, 's/b.webm': 404, 's/c.webm': 403, 's/d.webm': 503}
+
+    class FakeResponse:
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+    class FakeBatch:
+        def __init__(self):
+            self._responses = []
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    class FakeBlob:
+        def __init__(self, bucket, name):
+            self.bucket = bucket
+            self.name = name
+
+        def delete(self):
+            self.bucket.current_batch._responses.append(
+                FakeResponse(statuses[self.name])
+            )
+
+    class FakeBucket:
+        def __init__(self):
+            self.client = self
+            self.current_batch = None
+
+        def batch(self, raise_exception=True):
+            self.current_batch = FakeBatch()
+            return self.current_batch
+
+        def blob(self, name):
+            return FakeBlob(self, name)
+
+    monkeypatch.setattr(sabre, 'bucket', FakeBucket())
+
+    sabre.delete_many_from_firebase(list(statuses))
+
+    [record] = caplog.records
+    message = record.getMessage()
+    assert 's/c.webm (403)' in message
+    assert 's/d.webm (503)' in message
+    assert 's/a.webm' not in message
+    assert 's/b.webm' not in message
+
+
+def test_download_recordings_reports_failed_job(monkeypatch, caplog):
+    def fail(session_id):
+        raise RuntimeError('listing failed')
+
+    monkeypatch.setattr(sabre, 'load_user_mappings', fail)
+    client = sabre.app.test_client()
+
+    job_id = client.post('/download-recordings').get_json()['job_id']
+    for _ in range(100):
+        res = client.get(f'/download-recordings/{job_id}')
+        if res.status_code != 202:
+            break
+        time.sleep(0.01)
+
+    assert res.status_code == 502
+    assert res.get_json()['status'] == 'failed'
+    assert 'listing failed' in caplog.text
@@ -0,0 +1,118 @@
+import base64
+import io
+import json
+import os
+
+import google_crc32c
+import pytest
+import requests
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+
+os.environ['FIREBASE_CREDENTIALS'] = '{}'
+
+import app as sabre  # noqa: E402
+
+
+class FakeStorageSession:
+    """Stands in for the storage client's HTTP session, keeping uploads in memory."""
+
+    is_mtls = False
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        headers = headers or {}
+        if hasattr(data, 'read'):
+            data = data.read()
+        if 'uploadType=multipart' in url:
+            metadata, body = self._split_multipart(data, headers)
+            return self._store(metadata, body)
+        if 'uploadType=resumable' in url:
+            session_url = f'https://upload.example/{len(self.uploads)}'
+            self.uploads[session_url] = (json.loads(data), b'')
+            return self._response(200, headers={'location': session_url})
+        metadata, body = self.uploads[url]
+        body += data
+        self.uploads[url] = (metadata, body)
+        if headers['content-range'].endswith('/*'):
+            return self._response(308, headers={'range': f'bytes=0-{len(body) - 1}'})
+        return self._store(metadata, body)
+
+    def _split_multipart(self, data, headers):
+        content_type = headers['content-type']
+        if isinstance(content_type, str):
+            content_type = content_type.encode()
+        boundary = content_type.split(b'boundary=')[1].strip(b'"')
+        parts = data.split(b'--' + boundary)
+        metadata = json.loads(parts[1].split(b'\r\n\r\n', 1)[1])
+        body = parts[2].split(b'\r\n\r\n', 1)[1][:-2]
+        return metadata, body
+
+    def _store(self, metadata, body):
+        self.objects[metadata['name']] = (metadata, body)
+        crc = base64.b64encode(google_crc32c.Checksum(body).digest()).decode()
+        resource = dict(metadata, bucket='b', size=str(len(body)), crc32c=crc)
+        return self._response(200, json.dumps(resource).encode())
+
+    def _response(self, status, content=b'{}', headers=None):
+        response = requests.Response()
+        response.status_code = status
+        response._content = content
+        response.headers.update(headers or {})
+        response.headers.setdefault('content-type', 'application/json')
+        return response
+
+
+@pytest.fixture
+def storage_session(monkeypatch):
+    session = FakeStorageSession()
+    client = storage.Client(
+        project='p', credentials=AnonymousCredentials(), _http=session
+    )
+    monkeypatch.setattr(sabre, 'bucket', client.bucket('b'))
+    return session
+
+
+@pytest.mark.parametrize('size', [1024, 9 * 1024 * 1024])
+@pytest.mark.parametrize('chunked', [False, True])
+def test_upload_audio_stores_clip_and_sentence(storage_session, size, chunked):
+    audio = os.urandom(size)
+    body = 'Ein Satz.\n'.encode('utf-8') + audio
+    client = sabre.app.test_client()
+    if chunked:
+        response = client.post(
+            '/upload-audio', input_stream=io.BytesIO(body),
+            headers={'Transfer-Encoding': 'chunked'}, content_type='audio/webm',
+            environ_overrides={'wsgi.input_terminated': True},
+        )
+    else:
+        response = client.post('/upload-audio', data=body, content_type='audio/webm')
+
+    assert response.status_code == 200
+    [(metadata, stored)] = storage_session.objects.values()
+    assert metadata['metadata'] == {'sentence': 'Ein Satz.'}
+    assert stored == audio
+
+
+@pytest.mark.parametrize('body', [b'', b'no newline', b'\n', b'\r\n', b'\xff\n'])
+def test_upload_audio_rejects_bad_sentence(storage_session, body):
+    response = sabre.app.test_client().post(
+        '/upload-audio', data=body + b'audio', content_type='audio/webm'
+    )
+
+    assert response.status_code == 400
+    assert not storage_session.objects
+
+
+def test_upload_audio_ignores_line_ending(storage_session):
+    client = sabre.app.test_client()
+    for body in [b'Satz\naudio', b'Satz\r\naudio']:
+        response = client.post('/upload-audio', data=body, content_type='audio/webm')
+        assert response.status_code == 200
+
+    [(metadata, stored)] = storage_session.objects.values()
+    assert metadata['metadata'] == {'sentence': 'Satz'}
+    assert stored == b'audio'